@@ -0,0 +1,192 @@
+'''
+cohorts.py: compare each student against their own class, campus and program
+
+Cohorts come from the roster file: getRosterFromFile matches it to the students in the data frame, and
+assignCohorts attaches it to the response matrix.  Per-cohort concept averages are
+computed from the response matrix with one sparse product per level and cached on it, so every
+student's focus table is a lookup into those aggregates rather than a rescan of the data.
+'''
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+import data_prep
+import response_matrix
+
+COHORT_LEVELS = ['class','campus','program']
+
+def getRosterFromFile(df,rosterPath,levels=COHORT_LEVELS):
+    '''
+    one row per student in df with their cohorts, read from the roster file.  The roster is matched on
+    studentID, or on firstName and lastName if it has no studentID column, like data_prep.assignToClass,
+    but it is not merged into df, so the frame is not copied.
+    '''
+    roster = data_prep.loadRoster(rosterPath)
+    missing = [level for level in levels if level not in roster.columns]
+    if missing:
+        raise ValueError("Roster file %s has no %s column" % (rosterPath,', '.join(missing)))
+    keys = ['studentID'] if 'studentID' in roster.columns else ['firstName','lastName']
+
+    #one row per student, from each student's first row in df
+    _, firstRow = np.unique(df['studentID'].values, return_index=True)
+    students = df.iloc[firstRow][['studentID','firstName','lastName']]
+    roster = roster.drop_duplicates(keys)[keys+levels]
+    return pd.merge(students[['studentID']+[k for k in keys if k!='studentID']],roster,how='left',on=keys)[['studentID']+levels]
+
+def getRosterFromFrame(df,levels=COHORT_LEVELS):
+    '''
+    one row per student with their cohorts, from a data frame that went through data_prep.assignToClass.
+    Works whether the roster file was keyed by studentID or by firstName and lastName.
+    '''
+    missing = [level for level in levels if level not in df.columns]
+    if missing:
+        raise ValueError("Data frame has no %s column; merge the roster with data_prep.assignToClass first" % ', '.join(missing))
+    return df[['studentID']+levels].drop_duplicates('studentID')
+
+def assignCohorts(rm,roster,levels=COHORT_LEVELS):
+    '''
+    attach cohort membership to the response matrix, dropping any cached cohort aggregates.
+    Prints a warning listing the students the roster gives no cohort.
+    args:
+        rm: response matrix from response_matrix.buildResponseMatrix
+        roster: dataframe with studentID and one column per level, from getRosterFromFile or getRosterFromFrame
+        levels: cohort levels to use
+    returns:
+        rm, with rm['cohorts'] aligned to rm['students']
+    '''
+    missing = [level for level in ['studentID']+levels if level not in roster.columns]
+    if missing:
+        raise ValueError("Roster is missing columns: %s; use getRosterFromFile to match a roster file "
+                         "to the students" % ', '.join(missing))
+    roster = roster.drop_duplicates('studentID').set_index('studentID')
+    rm['cohorts'] = roster.reindex(rm['students'])[levels].reset_index(drop=True)
+
+    #students with no cohort get an empty focus table, so say who they are
+    unmatched = rm['students'][rm['cohorts'].isnull().any(axis=1).values]
+    if len(unmatched)>0:
+        print "Warning: %i students have no %s in the roster: %s" % (len(unmatched),' or '.join(levels),
+                                                                     ', '.join(str(s) for s in unmatched))
+    for key in list(rm['cache'].keys()):
+        if key[0]=='cohort':
+            del rm['cache'][key]
+    return rm
+
+def getMembership(rm,level):
+    '''
+    students x cohorts indicator matrix for one level.  Students with no cohort get an empty row.
+    returns:
+        membership: CSR matrix
+        cohortIdx: cohort column of each student, -1 if none
+        names: cohort names, in column order
+    '''
+    if 'cohorts' not in rm:
+        raise ValueError("No cohorts assigned; call assignCohorts first")
+    labels = rm['cohorts'][level]
+    known = labels.notnull().values
+    names, codes = np.unique(labels[known].values.astype(str), return_inverse=True)
+    cohortIdx = np.full(len(labels),-1,dtype=int)
+    cohortIdx[known] = codes
+    rows = np.where(known)[0]
+    membership = sp.csr_matrix((np.ones(len(rows)),(rows,codes)),shape=(len(labels),len(names)))
+    return membership, cohortIdx, names
+
+def getCohortAggregates(rm,level,testID=None,subject=None):
+    '''
+    Average concept score within every cohort of a level, for one test and subject.  Cached on the response matrix.
+    returns:
+        dictionary with cohortAvg and numStudentsGivenConcept (cohorts x concepts arrays, NaN/0 where
+        nobody in the cohort was given the concept), cohortIdx and names from getMembership
+    '''
+    key = ('cohort',level,testID,subject)
+    if key in rm['cache']:
+        return rm['cache'][key]
+
+    agg = response_matrix.getClassAggregates(rm,testID,subject)
+    membership, cohortIdx, names = getMembership(rm,level)
+
+    #student x concept matrices of scores, and of 1s where the concept was given
+    given = agg['numQuestions'].copy()
+    given.data = np.ones(len(given.data))
+    scores = agg['numQuestions'].copy()
+    scores.data = agg['numCorrect'].data/agg['numQuestions'].data
+
+    numStudents = membership.T.dot(given).toarray()
+    cohortSum = membership.T.dot(scores).toarray()
+    cohortAvg = np.full(numStudents.shape,np.nan)
+    hasStudents = numStudents>0
+    cohortAvg[hasStudents] = cohortSum[hasStudents]/numStudents[hasStudents]
+
+    cohortAgg = {'cohortAvg':cohortAvg,
+                 'numStudentsGivenConcept':numStudents,
+                 'cohortIdx':cohortIdx,
+                 'names':names}
+    rm['cache'][key] = cohortAgg
+    return cohortAgg
+
+def buildFocusTable(rm,studentID,testID,subject,level,minWrong=5):
+    '''
+    Focus table for one student, comparing against their own cohort at the given level
+    returns:
+        rec: top 5 concepts ranked by weighted difference between the student's score and the cohort avg
+            (in the cohortAvg column).
+            Empty if the student has no cohort at this level.
+    '''
+    agg = response_matrix.getClassAggregates(rm,testID,subject)
+    cohortAgg = getCohortAggregates(rm,level,testID,subject)
+    i = response_matrix.getStudentRow(rm,studentID)
+    k = cohortAgg['cohortIdx'][i]
+    ws = response_matrix.getWorkingSet(agg,i)
+
+    cohortAvg = np.full(len(ws['cols']),np.nan)
+    if k>=0:
+        cohortAvg = cohortAgg['cohortAvg'][k,ws['cols']]
+    rec = response_matrix.focusFrame(rm,ws,cohortAvg,agg['conceptWeight'],minWrong,avgColumn='cohortAvg')
+    if k<0:
+        rec = rec.iloc[:0]
+    order = np.argsort(rec['weightedScoreDiff'].values,kind='mergesort')
+    return rec.iloc[order].head()
+
+def buildAllFocusTables(rm,testID,subject,levels=COHORT_LEVELS,minWrong=5,numConcepts=5):
+    '''
+    Focus tables for every student against their class, campus and program, in one pass per level
+    args:
+        rm: response matrix with cohorts assigned
+        testID: test to build the tables from (None for all tests)
+        subject: math, reading, sentence, or writing
+        levels: cohort levels to compare against
+        minWrong: minimum number of wrong answers to make a recommendation
+        numConcepts: number of concepts to keep per student and level
+    returns:
+        dataframe with a level and cohort column, and each student's top concepts for each level
+    '''
+    agg = response_matrix.getClassAggregates(rm,testID,subject)
+    ws = response_matrix.getWorkingSet(agg)
+
+    tables = []
+    for level in levels:
+        cohortAgg = getCohortAggregates(rm,level,testID,subject)
+        k = cohortAgg['cohortIdx'][ws['rows']]
+        inCohort = k>=0
+        cohortAvg = np.full(len(k),np.nan)
+        cohortAvg[inCohort] = cohortAgg['cohortAvg'][k[inCohort],ws['cols'][inCohort]]
+
+        rec = response_matrix.focusFrame(rm,ws,cohortAvg,agg['conceptWeight'],minWrong,avgColumn='cohortAvg')
+        cohortOfRow = k[rec.index.values]
+        rec = rec[cohortOfRow>=0]
+        cohortOfRow = cohortOfRow[cohortOfRow>=0]
+
+        #rank within each student, and keep the top few
+        order = np.lexsort((rec['weightedScoreDiff'].values,rec['studentID'].values))
+        rec = rec.iloc[order]
+        cohortOfRow = cohortOfRow[order]
+        studentIDs = rec['studentID'].values
+        newStudent = np.r_[True,studentIDs[1:]!=studentIDs[:-1]]
+        groupStart = np.maximum.accumulate(np.where(newStudent,np.arange(len(rec)),0))
+        keep = (np.arange(len(rec)) - groupStart) < numConcepts
+
+        rec = rec[keep].copy()
+        rec.insert(1,'level',level)
+        rec.insert(2,'cohort',cohortAgg['names'][cohortOfRow[keep]])
+        tables.append(rec)
+
+    return pd.concat(tables,ignore_index=True)
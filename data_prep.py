@@ -77,7 +77,7 @@ def addNumConcepts(rawDF):
     returns: df with numConcepts attached
     '''
 
-    df = rawDF.copy()
+    df = rawDF
     qg = yp.groupData(df,['firstName','testID','testQuestionNumber','testSectionNumber'],'correct')
     qg2 = qg.groupby(['testID','testQuestionNumber','testSectionNumber']).max().reset_index()
     qg2.sort(['testID','testSectionNumber','testQuestionNumber','firstName'])
@@ -99,26 +99,47 @@ def makeStudentIDs(df,index_column_list=['firstName','lastName']):
     
     return df2
 
-def assignToClass(rawDF):
-    df = rawDF.copy()
-    df.loc[df['firstName'].isin(['Aeson','Ahna','Akayla','Allan','Alondra']),'class']="A"
-    df.loc[df['firstName'].isin(['Amanda', 'Ashli',
-       'Auston', 'Ayanna', 'Cheyanne', 'Clementina']),'class']="B"
-    return df
+def loadRoster(rosterPath='data/roster.csv'):
+    '''
+    read the cohort definitions: one row per student, with the class, campus and program they belong to.
+    Students are identified by studentID, or by firstName and lastName if the roster has no studentID column.
+    '''
+    return pd.read_csv(rosterPath)
+
+def assignToClass(rawDF,rosterPath='data/roster.csv'):
+    '''
+    merge each student's class, campus and program from the roster file into df
+    returns: df with cohort columns attached.  Students missing from the roster get null cohorts.
+    '''
+    roster = loadRoster(rosterPath)
+    if 'studentID' in roster.columns and 'studentID' in rawDF.columns:
+        keys = ['studentID']
+    else:
+        keys = ['firstName','lastName']
+    roster = roster.drop_duplicates(keys)
+    cohortColumns = [c for c in roster.columns if c not in ['studentID','firstName','lastName']]
+    df = rawDF.drop([c for c in cohortColumns if c in rawDF.columns],axis=1)
+    return pd.merge(df,roster[keys+cohortColumns],how='left',on=keys)
 
 #Define classes
 def createClass(df,students,className):
-    df.loc[df['firstName'].isin(students),'class']=className
+    '''
+    subset of df belonging to one class.
+    Pass students=None to use the class from the roster (see assignToClass); a list of first names
+    assigns those students to the class first.
+    '''
+    if students is not None:
+        df.loc[df['firstName'].isin(students),'class']=className
     return df.loc[df['class']==className,:]
 
-def main(fn, makeIDs, assignClass):
+def main(fn, makeIDs, assignClass, rosterPath='data/roster.csv'):
     rawDF = pd.read_csv(fn)
     df = clean_data(rawDF)
     df = addNumConcepts(df)
     if makeIDs:
         df = makeStudentIDs(df)
     if assignClass:
-        df = assignToClass(df)
+        df = assignToClass(df,rosterPath)
     return df
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+'''
+percentiles.py: percentile rank of each student's concept scores
+
+For every (testID, subject, concept) we keep a sketch of the score distribution: the sorted distinct scores
+and the cumulative number of students at or below each one.  Concept scores are a fraction of a handful of
+questions, so there are few distinct values and the sketch is exact.  A percentile rank is then a binary
+search, and sketches merge by adding counts, so cohorts can be combined and program-wide distributions
+updated as new tests arrive without rescanning the old ones.
+
+Two kinds of program-wide sketch are kept, because they describe different scores:
+    (None, subject, concept): each student's score over all tests combined, matching a focus table
+        built with testID None.  Rebuilt from the response matrix.
+    (POOLED_TESTS, subject, concept): every per-test score from every test, one per student per test
+        sat.  Merged incrementally with addTests.
+'''
+import pandas as pd
+import numpy as np
+
+import response_matrix
+
+#testID key of the sketches pooling every per-test score
+POOLED_TESTS = '*'
+
+def makeSketch(scores):
+    '''
+    sketch of a set of scores
+    returns: (sorted distinct scores, cumulative count of scores at or below each)
+    '''
+    values, counts = np.unique(scores, return_counts=True)
+    return values, np.cumsum(counts)
+
+def mergeSketches(a,b):
+    '''
+    sketch of the union of the scores behind two sketches
+    '''
+    values = np.concatenate([a[0],b[0]])
+    counts = np.concatenate([np.diff(np.r_[0,a[1]]),np.diff(np.r_[0,b[1]])])
+    merged, inverse = np.unique(values, return_inverse=True)
+    return merged, np.cumsum(np.bincount(inverse,weights=counts)).astype(int)
+
+def getPercentileRank(sketch,scores):
+    '''
+    midrank percentile of scores within a sketch: % of students scoring below, plus half of those tied
+    args:
+        sketch: from makeSketch
+        scores: a score or array of scores
+    '''
+    values, cumCounts = sketch
+    cum = np.r_[0,cumCounts]
+    below = cum[np.searchsorted(values,scores,side='left')]
+    atOrBelow = cum[np.searchsorted(values,scores,side='right')]
+    return 100.0*(below + atOrBelow)/(2.0*cumCounts[-1])
+
+def buildScoreDistributions(rm,testIDs=None,students=None):
+    '''
+    Sketch the distribution of every student's score on every concept, for each test
+    args:
+        rm: response matrix from response_matrix.buildResponseMatrix
+        testIDs: tests to sketch (default every test in rm).  None in the list sketches
+            the scores over all tests combined.
+        students: optionally only these studentIDs, eg. one cohort
+    returns:
+        dists: dictionary of sketches keyed by (testID, subject, concept)
+    '''
+    concepts = rm['concepts']
+    if testIDs is None:
+        testIDs = rm['questions']['testID'].unique()
+    if students is not None:
+        keepRows = pd.Series(rm['students']).isin(students).values
+
+    dists = {}
+    for testID in testIDs:
+        numQuestions, numCorrect = response_matrix.getConceptCounts(rm,response_matrix.questionMask(rm,testID))
+        rows = np.repeat(np.arange(numQuestions.shape[0]),np.diff(numQuestions.indptr))
+        cols = numQuestions.indices
+        scores = numCorrect.data/numQuestions.data
+        if students is not None:
+            cols, scores = cols[keepRows[rows]], scores[keepRows[rows]]
+        if len(cols)==0:
+            continue
+
+        #split the scores by concept
+        order = np.argsort(cols,kind='mergesort')
+        cols, scores = cols[order], scores[order]
+        bounds = np.flatnonzero(np.diff(cols)) + 1
+        for conceptCols, conceptScores in zip(np.split(cols,bounds),np.split(scores,bounds)):
+            c = conceptCols[0]
+            dists[(testID,concepts['subject'].iat[c],concepts['concept'].iat[c])] = makeSketch(conceptScores)
+    return dists
+
+def mergeDistributions(dists,other):
+    '''
+    merge two sets of sketches key by key, eg. the same tests for two cohorts
+    '''
+    merged = dict(dists)
+    for key, sketch in other.items():
+        merged[key] = mergeSketches(merged[key],sketch) if key in merged else sketch
+    return merged
+
+def poolTests(dists):
+    '''
+    program-wide sketches, pooling every per-test score.  Keyed by (POOLED_TESTS, subject, concept).
+    '''
+    pooled = {}
+    for (testID, subject, concept), sketch in dists.items():
+        if testID is None or testID==POOLED_TESTS:
+            continue
+        key = (POOLED_TESTS,subject,concept)
+        pooled[key] = mergeSketches(pooled[key],sketch) if key in pooled else sketch
+    return pooled
+
+def addTests(dists,newDists):
+    '''
+    fold the sketches of newly arrived tests into dists, updating the pooled sketches incrementally.
+    newDists should only hold tests that are not in dists yet.  The all-tests-combined (None) sketches
+    are not updated, since a new test changes students' combined scores; rebuild them with
+    buildScoreDistributions(rm,[None]).
+    '''
+    return mergeDistributions(mergeDistributions(dists,newDists),poolTests(newDists))
+
+def getDistributions(rm):
+    '''
+    per-test, pooled and all-tests sketches for everyone in the response matrix.  Cached on the response matrix.
+    '''
+    key = ('percentiles',)
+    if key not in rm['cache']:
+        dists = buildScoreDistributions(rm)
+        dists.update(poolTests(dists))
+        dists.update(buildScoreDistributions(rm,[None]))
+        rm['cache'][key] = dists
+    return rm['cache'][key]
+
+def addPercentileRanks(rm,rec,testID,dists=None):
+    '''
+    add a percentile column to a focus table built from the response matrix: the student's percentile rank
+    on each concept among everyone given it on this test.  When testID is None, the student's score over all
+    tests is ranked against everyone's score over all tests.
+    args:
+        rm: response matrix
+        rec: dataframe with studentID, subject and concept
+        testID: test the table was built from
+        dists: sketches to rank against (default getDistributions(rm))
+    returns:
+        rec with a percentile column
+    '''
+    if dists is None:
+        dists = getDistributions(rm)
+    rec = rec.copy()
+    rec['percentile'] = np.nan
+    if rec.shape[0]==0:
+        return rec
+
+    #unrounded scores, from the cached aggregates
+    agg = response_matrix.getClassAggregates(rm,testID,None)
+    rows = np.searchsorted(rm['students'],rec['studentID'].values)
+    conceptIndex = rm['concepts'].reset_index()
+    cols = pd.merge(rec[['subject','concept']],conceptIndex,how='left',on=['subject','concept'])['index'].values
+    numQuestions = np.asarray(agg['numQuestions'][rows,cols]).ravel()
+    numCorrect = np.asarray(agg['numCorrect'][rows,cols]).ravel()
+    scores = numCorrect/numQuestions
+
+    percentile = np.full(rec.shape[0],np.nan)
+    for (subject, concept), idx in rec.groupby(['subject','concept']).indices.items():
+        sketch = dists.get((testID,subject,concept))
+        if sketch is not None:
+            percentile[idx] = getPercentileRank(sketch,scores[idx])
+    rec['percentile'] = percentile.round(0)
+    return rec
@@ -0,0 +1,321 @@
+'''
+regression.py: golden-output regression harness for the report pipeline
+
+Runs data_prep and score_report end to end on a fixed synthetic dataset, and compares every student's
+focus, opportunity and careless tables, scores_by_concept CSVs and HTML reports with the golden copies in
+regression/golden.  The data includes a retake and questions with no concept, which the row-wise and
+matrix paths must count the same way.  The golden row-wise focus tables come from buildFocusTableFromFrame,
+which is the original pipeline; the sparse response-matrix path is checked against it student by student,
+and the focus tables the reports print (with percentiles, and against each student's class) are golden-checked
+too.  Each stage also has a time and peak memory budget, so a speed-up that changes a student's
+recommendations, or a change that makes a stage slower or bigger, fails the run.
+
+usage:
+    python regression.py            compare with the golden outputs and check the budgets
+    python regression.py --update   rewrite the golden outputs, after a change that is meant to alter them
+'''
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+import data_prep
+import response_matrix
+import score_report
+from yleana_util import getCurrentRSS, getPeakRSS, resetPeakRSS
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'regression','golden')
+SEED = 2015
+TEST_IDS = ['YL_1_PP_SAT_S0114','YL_2_PP_SAT_S0112']
+SUBJECTS = ['sentence','reading','math','writing']
+#cohort level the reports and cohort focus tables compare against
+COHORT_LEVEL = 'class'
+
+#seconds, and how far resident memory (MB) may peak above its level at the start of the stage, allowed for
+#each stage.  Set from measured runs (python 2.7, pandas 0.19.2): about 2x the slowest time and 10 MB over the
+#largest peak seen, which was prep 0.6 s/+3.5 MB, matrix 0.1 s/+3.2 MB, parity 89 s/+0.5 MB,
+#tables 59 s/+2.8 MB and reports 43 s/+1.0 MB.
+STAGE_BUDGETS = {'prep':(2,15),
+                 'matrix':(1,15),
+                 'parity':(180,10),
+                 'tables':(120,15),
+                 'reports':(90,10)}
+
+#memory budget handed to buildAllStudentReportsBounded
+REPORT_MEMORY_BUDGET_MB = 512
+
+def makeSyntheticData(workDir,seed=SEED,numStudents=30,questionsPerSection=40):
+    '''
+    write a raw test file, concept map and roster in the same layout as the semi export and data/roster.csv,
+    for two tests and four subjects.  Every tenth math question has no concept, one student sat the first test
+    twice, and the first student is missing from the roster.
+    returns: paths to the raw csv, the concept map and the roster
+    '''
+    rng = np.random.RandomState(seed)
+    choices = np.array(['A','B','C','D','E'])
+    rows = []
+    conceptMap = []
+    for subject in SUBJECTS:
+        for c in range(6):
+            conceptMap.append((subject+'_'+str(c),subject,subject+'_broad_'+str(c//2)))
+    for testID in TEST_IDS:
+        for section, subject in enumerate(SUBJECTS):
+            for q in range(1,questionsPerSection+1):
+                concepts = [subject+'_'+str(c) for c in rng.choice(6,size=rng.randint(1,3),replace=False)]
+                if subject=='math' and q%10==0:
+                    concepts = [np.nan]
+                correctAnswer = choices[rng.randint(5)]
+                difficulty = ['easy','medium','hard'][rng.randint(3)]
+                for s in range(numStudents):
+                    ability = 0.4 + 0.5*s/float(numStudents)
+                    if rng.rand() < 0.05:
+                        answer = 'BLANK'
+                    elif rng.rand() < ability:
+                        answer = correctAnswer
+                    else:
+                        answer = choices[rng.randint(5)]
+                    for concept in concepts:
+                        rows.append((1000+s,'First'+str(s),'Last'+str(s),testID,section+1,q,subject,
+                                     concept,answer,correctAnswer,difficulty))
+    raw = pd.DataFrame(rows,columns=['studentUniqueID','firstName','lastName','testName','testSectionNumber',
+                                     'testQuestionNumber','type','concept','answer','CorrectAnswer','difficultyLevel'])
+
+    #a second sitting of the first test by one student, getting right what they got wrong the first time
+    retake = raw[(raw['studentUniqueID']==1003) & (raw['testName']==TEST_IDS[0])].copy()
+    wasCorrect = (retake['answer']==retake['CorrectAnswer']).values
+    retake['answer'] = np.where(wasCorrect,'BLANK',retake['CorrectAnswer'].values)
+    raw = pd.concat([raw,retake],ignore_index=True)
+
+    #a question with no answer key, which clean_data drops
+    raw.loc[(raw['testName']==TEST_IDS[0]) & (raw['testQuestionNumber']==1),'CorrectAnswer'] = np.nan
+
+    #a roster keyed by name, like data/roster.csv without studentIDs
+    roster = pd.DataFrame({'firstName':['First'+str(s) for s in range(1,numStudents)],
+                           'lastName':['Last'+str(s) for s in range(1,numStudents)],
+                           'class':['class_'+str(s%3) for s in range(1,numStudents)],
+                           'campus':['campus_'+str(s%2) for s in range(1,numStudents)],
+                           'program':'program_0'})
+
+    rawPath = os.path.join(workDir,'raw.csv')
+    conceptMapPath = os.path.join(workDir,'concept_map.csv')
+    rosterPath = os.path.join(workDir,'roster.csv')
+    raw.to_csv(rawPath,index=False)
+    pd.DataFrame(conceptMap,columns=['concept','subject','broad_concept']).to_csv(conceptMapPath,index=False)
+    roster[['firstName','lastName','class','campus','program']].to_csv(rosterPath,index=False)
+    return rawPath, conceptMapPath, rosterPath
+
+def prepData(rawPath,conceptMapPath):
+    '''
+    the data_prep steps from score_report.main
+    '''
+    df = data_prep.clean_data(pd.read_csv(rawPath))
+    df = data_prep.mapConcepts(df,conceptMapPath)
+    df = data_prep.addNumConcepts(df)
+    return data_prep.addDates(df)
+
+def buildTables(df,rm,testID):
+    '''
+    focus, opportunity and careless tables for every student and subject, stacked into one dataframe each.
+    focus uses the row-wise path, so it can be checked against the original pipeline.  focus_matrix and
+    focus_cohort are the tables the reports print: from the response matrix with percentiles, against
+    everyone and against each student's class.
+    '''
+    tables = {'focus':[],'focus_matrix':[],'focus_cohort':[],'opportunity':[],'careless':[]}
+    for studentID in np.sort(df['studentID'].unique()):
+        for subject in SUBJECTS:
+            recs = {'focus':score_report.buildFocusTable(df,studentID,testID,subject,toHTML=False),
+                    'focus_matrix':score_report.buildFocusTable(df,studentID,testID,subject,toHTML=False,rm=rm),
+                    'focus_cohort':score_report.buildFocusTable(df,studentID,testID,subject,toHTML=False,rm=rm,
+                                                                cohortLevel=COHORT_LEVEL),
+                    'opportunity':score_report.buildOpportunityTable(df,studentID,testID,subject,difficulty=None,toHTML=False),
+                    'careless':score_report.buildOpportunityTable(df,studentID,testID,subject,difficulty='easy',toHTML=False)}
+            for name, rec in recs.items():
+                rec = rec.copy()
+                rec.insert(0,'studentID',studentID)
+                rec.insert(1,'subject',subject)
+                tables[name].append(rec)
+    return dict((name,pd.concat(recs,ignore_index=True)) for name, recs in tables.items())
+
+def compareFocusPaths(df,rm,testIDs):
+    '''
+    compare the response-matrix focus table with the row-wise one, for every student, subject and test.
+    The row-wise concept weights group students by firstName and the matrix ones by studentID, so the
+    row-wise path runs on a copy where firstName is the studentID.
+    returns: list of failures
+    '''
+    byID = df.copy()
+    byID['firstName'] = byID['studentID'].astype(str)
+    failures = []
+    for testID in testIDs:
+        for studentID in rm['students']:
+            for subject in SUBJECTS:
+                frame = score_report.buildFocusTableFromFrame(byID,studentID,testID,subject)
+                matrix = response_matrix.buildFocusTable(rm,studentID,testID,subject)
+                diff = compareFrames(frame,matrix)
+                if diff is not None:
+                    failures.append("focus table for student %s, %s, test %s: matrix path differs from row-wise path: %s"
+                                    % (studentID,subject,testID,diff))
+    return failures
+
+def runStage(name,stats,func,*args):
+    '''
+    run one stage, recording its time and how far its peak resident memory rose above the memory at its start
+    '''
+    if not resetPeakRSS():
+        print "Warning: cannot reset the peak RSS on this platform, so %s's peak includes earlier stages" % name
+    startRSS = getCurrentRSS()
+    start = time.time()
+    result = func(*args)
+    stats[name] = (time.time()-start,getPeakRSS()-startRSS)
+    print "%-8s %6.2f s %+6.1f MB peak" % (name,stats[name][0],stats[name][1])
+    return result
+
+def runPipeline(workDir,outDir):
+    '''
+    run the pipeline on the synthetic data in workDir, and write the outputs to compare into outDir
+    returns:
+        stats: dictionary of (seconds, peak RSS growth in MB) for each stage
+        failures: differences between the matrix and row-wise focus tables
+    '''
+    testID = TEST_IDS[1]
+    for path in ['plots','reports/'+testID,'scores_by_concept/'+testID]:
+        os.makedirs(os.path.join(workDir,path))
+    rawPath, conceptMapPath, rosterPath = makeSyntheticData(workDir)
+
+    stats = {}
+    df = runStage('prep',stats,prepData,rawPath,conceptMapPath)
+    rm = runStage('matrix',stats,score_report.prepareResponseMatrix,df,rosterPath,COHORT_LEVEL)
+    failures = runStage('parity',stats,compareFocusPaths,df,rm,TEST_IDS+[None])
+    tables = runStage('tables',stats,buildTables,df,rm,testID)
+
+    #score_report writes scores_by_concept and the reports relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        runStage('reports',stats,score_report.buildAllStudentReportsBounded,df,testID,TEST_IDS[0],'./',
+                 REPORT_MEMORY_BUDGET_MB,rosterPath,COHORT_LEVEL)
+    finally:
+        os.chdir(cwd)
+
+    for name, table in tables.items():
+        table.to_csv(os.path.join(outDir,name+'.csv'),index=False)
+    for outputs, pattern in [('scores_by_concept','*.csv'),('reports','*.html')]:
+        os.makedirs(os.path.join(outDir,outputs))
+        for path in glob.glob(os.path.join(workDir,outputs,testID,pattern)):
+            shutil.copy(path,os.path.join(outDir,outputs))
+    return stats, failures
+
+def compareFiles(goldenPath,newPath):
+    '''
+    compare two outputs: csv files with a small tolerance on numbers, anything else as text
+    returns: a description of the first difference, or None if they match
+    '''
+    if not goldenPath.endswith('.csv'):
+        golden, new = open(goldenPath).read().splitlines(), open(newPath).read().splitlines()
+        for line, (g, n) in enumerate(zip(golden,new)):
+            if g != n:
+                return "line %i: %s != %s" % (line+1,n.strip(),g.strip())
+        if len(golden) != len(new):
+            return "%i lines != %i lines" % (len(new),len(golden))
+        return None
+    return compareFrames(pd.read_csv(goldenPath),pd.read_csv(newPath))
+
+def compareFrames(golden,new):
+    '''
+    compare two dataframes row by row, with a small tolerance on numbers
+    returns: a description of the first difference, or None if they match
+    '''
+    golden = golden.reset_index(drop=True)
+    new = new.reset_index(drop=True)
+    if list(golden.columns) != list(new.columns):
+        return "columns %s != %s" % (list(new.columns),list(golden.columns))
+    if golden.shape != new.shape:
+        return "%i rows != %i rows" % (new.shape[0],golden.shape[0])
+    for col in golden.columns:
+        g, n = golden[col].values, new[col].values
+        if golden[col].dtype.kind in 'biuf' and new[col].dtype.kind in 'biuf':
+            same = np.isclose(g.astype(float),n.astype(float),atol=1e-6,equal_nan=True)
+        else:
+            same = (golden[col].astype(str).values == new[col].astype(str).values) | \
+                   (golden[col].isnull().values & new[col].isnull().values)
+        if not same.all():
+            row = np.flatnonzero(~same)[0]
+            return "column %s, row %i: %s != %s" % (col,row,n[row],g[row])
+    return None
+
+def listOutputs(outDir):
+    '''
+    paths of the outputs to compare, relative to outDir
+    '''
+    paths = glob.glob(os.path.join(outDir,'*.csv')) + glob.glob(os.path.join(outDir,'scores_by_concept','*.csv')) \
+            + glob.glob(os.path.join(outDir,'reports','*.html'))
+    return sorted(os.path.relpath(p,outDir) for p in paths)
+
+def compareOutputs(outDir,goldenDir=GOLDEN_DIR):
+    '''
+    returns: list of failures comparing the outputs in outDir with the golden outputs
+    '''
+    failures = []
+    goldenFiles = listOutputs(goldenDir)
+    newFiles = listOutputs(outDir)
+    if not goldenFiles:
+        return ["no golden outputs in %s; run with --update on a known-good version first" % goldenDir]
+    for name in sorted(set(goldenFiles) - set(newFiles)):
+        failures.append("%s: missing from the new outputs" % name)
+    for name in sorted(set(newFiles) - set(goldenFiles)):
+        failures.append("%s: not in the golden outputs" % name)
+    for name in sorted(set(goldenFiles) & set(newFiles)):
+        diff = compareFiles(os.path.join(goldenDir,name),os.path.join(outDir,name))
+        if diff is not None:
+            failures.append("%s: %s" % (name,diff))
+    return failures
+
+def checkBudgets(stats,budgets=STAGE_BUDGETS):
+    '''
+    returns: list of stages that went over their time or memory budget
+    '''
+    failures = []
+    for name, (seconds, peakRSS) in sorted(stats.items()):
+        maxSeconds, maxGrowth = budgets[name]
+        if seconds > maxSeconds:
+            failures.append("%s took %.2f s, over its %i s budget" % (name,seconds,maxSeconds))
+        if peakRSS > maxGrowth:
+            failures.append("%s peaked %.1f MB above its starting RSS, over its %i MB budget" % (name,peakRSS,maxGrowth))
+    return failures
+
+def main(update=False):
+    '''
+    run the harness.  returns 0 if the outputs match and every stage is within budget, 1 otherwise
+    '''
+    workDir = tempfile.mkdtemp()
+    outDir = os.path.join(workDir,'outputs')
+    os.makedirs(outDir)
+    try:
+        stats, failures = runPipeline(workDir,outDir)
+        if update:
+            if os.path.exists(GOLDEN_DIR):
+                shutil.rmtree(GOLDEN_DIR)
+            shutil.copytree(outDir,GOLDEN_DIR)
+            print "Golden outputs written to %s" % GOLDEN_DIR
+        else:
+            failures += compareOutputs(outDir)
+        failures += checkBudgets(stats)
+    finally:
+        shutil.rmtree(workDir)
+
+    for failure in failures:
+        print "FAIL: " + failure
+    if failures:
+        return 1
+    print "OK"
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(update='--update' in sys.argv[1:]))
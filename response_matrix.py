@@ -0,0 +1,285 @@
+'''
+response_matrix.py: sparse student x question response matrix, and the scoring kernels built on it
+
+The cleaned data frame is long: one row per student, question and concept, and a student who sat a
+test twice has a row for each sitting.  Scoring it row-wise means regrouping the whole frame every time.
+Here the frame is packed once into
+    answered:  students x items (number of rows the student has for the item)
+    correct:   students x items (number of those rows the student got right)
+    incidence: items x concepts (1 where the item counts toward the concept)
+where an item is one question-concept pair, so concept scores, class averages and concept weights
+become sparse matrix products that count rows exactly as groupData does.
+'''
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+QUESTION_COLUMNS = ['testID','testSectionNumber','testQuestionNumber']
+CONCEPT_COLUMNS = ['subject','concept']
+
+#tests left out of concept weights (see yleana_util.getConceptWeight)
+WEIGHT_EXCLUDED_TESTS = ['BB','YL_6_PP_SAT_S0111']
+
+def _factorize(df,columns):
+    '''
+    assign an integer code to every unique combination of the columns
+    returns:
+        codes: array with the code of each row of df
+        keys: dataframe of the unique combinations, in code order
+    '''
+    keys = df[columns].drop_duplicates().reset_index(drop=True)
+    keys['code'] = np.arange(keys.shape[0])
+    codes = pd.merge(df[columns],keys,how='left',on=columns)['code'].values
+    return codes, keys[columns]
+
+def buildResponseMatrix(df):
+    '''
+    Pack the cleaned data frame into sparse matrices.  Rows with no concept are left out of the
+    concept counts, as the row-wise groupby leaves them out.
+    args:
+        df: cleaned dataframe, with studentID, testID, testSectionNumber, testQuestionNumber, subject, concept and correct
+    returns:
+        rm: dictionary with
+            students: sorted array of studentIDs (matrix rows)
+            questions: dataframe of testID, testSectionNumber, testQuestionNumber and subject
+            concepts: dataframe of subject and concept (incidence columns)
+            itemQuestion: question of each item (matrix columns)
+            answered, correct: students x items CSR matrices
+            incidence: items x concepts CSR matrix
+            cache: per-(testID, subject) aggregates, filled in as they are requested
+    '''
+    students, studentIdx = np.unique(df['studentID'].values, return_inverse=True)
+    questionIdx, questions = _factorize(df,QUESTION_COLUMNS)
+
+    #subject of each question
+    _, firstRow = np.unique(questionIdx, return_index=True)
+    questions['subject'] = df['subject'].values[firstRow]
+
+    hasConcept = df['concept'].notnull().values
+    conceptIdx, concepts = _factorize(df.loc[hasConcept],CONCEPT_COLUMNS)
+    studentIdx, questionIdx = studentIdx[hasConcept], questionIdx[hasConcept]
+    nS, nQ, nC = len(students), questions.shape[0], concepts.shape[0]
+
+    #one item per question-concept pair.  Several rows can land on the same student and item (a second
+    #sitting of the test, or granular concepts mapped to the same broad concept); the COO constructor
+    #sums them, so every row is counted
+    itemKeys, itemIdx = np.unique(questionIdx.astype(np.int64)*nC + conceptIdx, return_inverse=True)
+    nI = len(itemKeys)
+    answered = sp.coo_matrix((np.ones(len(itemIdx)),(studentIdx,itemIdx)),shape=(nS,nI)).tocsr()
+    correct = sp.coo_matrix((df['correct'].values[hasConcept].astype(float),(studentIdx,itemIdx)),shape=(nS,nI)).tocsr()
+    correct.eliminate_zeros()
+    incidence = sp.csr_matrix((np.ones(nI),(np.arange(nI),itemKeys % nC)),shape=(nI,nC))
+
+    return {'students':students,
+            'questions':questions,
+            'concepts':concepts,
+            'itemQuestion':itemKeys // nC,
+            'answered':answered,
+            'correct':correct,
+            'incidence':incidence,
+            'cache':{}}
+
+def questionMask(rm,testID=None,subject=None,excludeTests=[]):
+    '''
+    boolean mask over rm['questions']
+    args:
+        rm: response matrix from buildResponseMatrix
+        testID: keep only this test (default all tests)
+        subject: keep only this subject (default all subjects)
+        excludeTests: drop tests whose ID contains any of these strings
+    '''
+    questions = rm['questions']
+    mask = np.ones(questions.shape[0],dtype=bool)
+    if testID is not None:
+        mask &= (questions['testID']==testID).values
+    if subject is not None:
+        mask &= (questions['subject']==subject).values
+    for desc in excludeTests:
+        mask &= ~questions['testID'].str.contains(desc).values
+    return mask
+
+def getConceptCounts(rm,mask):
+    '''
+    Number of questions and number correct for every student and concept, over the masked questions
+    args:
+        rm: response matrix
+        mask: boolean mask over questions, from questionMask
+    returns:
+        numQuestions, numCorrect: students x concepts CSR matrices with identical sparsity structure
+    '''
+    incidence = sp.diags(mask[rm['itemQuestion']].astype(float),0).dot(rm['incidence'])
+    numQuestions = rm['answered'].dot(incidence).tocsr()
+    #answered+correct is nonzero exactly where answered is, so both products share one structure
+    both = (rm['answered'] + rm['correct']).dot(incidence).tocsr()
+    numQuestions.sort_indices()
+    both.sort_indices()
+    numCorrect = numQuestions.copy()
+    numCorrect.data = both.data - numQuestions.data
+    return numQuestions, numCorrect
+
+def getConceptWeight(rm,testID=None,subject=None):
+    '''
+    Calculate the relative weight of each concept within its subject area.
+    Matrix version of yleana_util.getConceptWeight
+    args:
+        rm: response matrix
+        testID: optionally restrict to one test
+        subject: optionally restrict to one subject
+    returns:
+        conceptWeight: array over rm['concepts'], NaN for concepts that do not appear
+    '''
+    mask = questionMask(rm,testID,subject,excludeTests=WEIGHT_EXCLUDED_TESTS)
+    nC = rm['concepts'].shape[0]
+    qsTotal = np.zeros(nC)
+    groups = np.zeros(nC)
+
+    #average number of questions per concept, over every student's sitting of every test
+    questions = rm['questions']
+    for test in questions.loc[mask,'testID'].unique():
+        numQuestions, _ = getConceptCounts(rm,mask & (questions['testID']==test).values)
+        qsTotal += np.bincount(numQuestions.indices,weights=numQuestions.data,minlength=nC)
+        groups += np.bincount(numQuestions.indices,minlength=nC)
+    meanQsPerConcept = np.full(nC,np.nan)
+    given = groups>0
+    meanQsPerConcept[given] = qsTotal[given]/groups[given]
+
+    #weight is the concept's share of the subject's questions
+    subjects = rm['concepts']['subject'].values
+    conceptWeight = np.full(nC,np.nan)
+    for subj in np.unique(subjects[given]):
+        inSubject = given & (subjects==subj)
+        conceptWeight[inSubject] = meanQsPerConcept[inSubject]/meanQsPerConcept[inSubject].sum()
+    return conceptWeight
+
+def getClassAggregates(rm,testID=None,subject=None):
+    '''
+    Per-concept scores for every student, the class average and the concept weights,
+    for one test and subject.  Cached on the response matrix.
+    returns:
+        dictionary with numQuestions, numCorrect (students x concepts CSR), classAvg,
+        numStudentsGivenConcept and conceptWeight (arrays over concepts)
+    '''
+    key = ('class',testID,subject)
+    if key in rm['cache']:
+        return rm['cache'][key]
+
+    nC = rm['concepts'].shape[0]
+    numQuestions, numCorrect = getConceptCounts(rm,questionMask(rm,testID,subject))
+    score = numCorrect.data/numQuestions.data
+    numStudents = np.bincount(numQuestions.indices,minlength=nC)
+    classAvg = np.full(nC,np.nan)
+    given = numStudents>0
+    classAvg[given] = np.bincount(numQuestions.indices,weights=score,minlength=nC)[given]/numStudents[given]
+
+    agg = {'numQuestions':numQuestions,
+           'numCorrect':numCorrect,
+           'classAvg':classAvg,
+           'numStudentsGivenConcept':numStudents,
+           'conceptWeight':getConceptWeight(rm,testID,subject)}
+    rm['cache'][key] = agg
+    return agg
+
+def getWorkingSet(agg,i=None):
+    '''
+    Entries of the cached count matrices, for one student row or (default) every student.
+    For one student these are views into the cached aggregates, so nothing is copied.
+    args:
+        agg: aggregates from getClassAggregates
+        i: student row, from getStudentRow
+    returns:
+        dictionary of rows, cols, numQuestions and numCorrect arrays, one entry per student and concept
+    '''
+    numQuestions, numCorrect = agg['numQuestions'], agg['numCorrect']
+    if i is None:
+        start, end = 0, numQuestions.nnz
+        rows = np.repeat(np.arange(numQuestions.shape[0]),np.diff(numQuestions.indptr))
+    else:
+        start, end = numQuestions.indptr[i], numQuestions.indptr[i+1]
+        rows = np.repeat(i,end-start)
+    return {'rows':rows,
+            'cols':numQuestions.indices[start:end],
+            'numQuestions':numQuestions.data[start:end],
+            'numCorrect':numCorrect.data[start:end]}
+
+def _perfFrame(rm,ws):
+    '''
+    long dataframe of a working set, in the layout of getPerfByStudent
+    '''
+    perf = rm['concepts'].iloc[ws['cols']].reset_index(drop=True)
+    perf.insert(0,'studentID',rm['students'][ws['rows']])
+    perf['numQuestions'] = np.rint(ws['numQuestions']).astype(int)
+    perf['numCorrect'] = np.rint(ws['numCorrect']).astype(int)
+    perf['score'] = ws['numCorrect']/ws['numQuestions']
+    perf['wrong'] = perf['numQuestions'] - perf['numCorrect']
+    return perf
+
+def getClassAvg(rm,testID=None,subject=None,passingThreshold=0.5):
+    '''
+    Matrix version of yleana_util.getClassAvg, grouping by studentID, subject and concept
+    returns:
+        studentPerf: dataframe of scores by student by concept
+        classPerf: dataframe of the number of students given each concept and their average score
+    '''
+    agg = getClassAggregates(rm,testID,subject)
+    studentPerf = _perfFrame(rm,getWorkingSet(agg))
+    studentPerf['passing'] = (studentPerf['score']>=passingThreshold).astype(int)
+
+    given = agg['numStudentsGivenConcept']>0
+    classPerf = rm['concepts'].loc[given].reset_index(drop=True)
+    classPerf['numStudentsGivenConcept'] = agg['numStudentsGivenConcept'][given]
+    classPerf['classAvg'] = agg['classAvg'][given]
+    return studentPerf, classPerf
+
+def getStudentRow(rm,studentID):
+    '''
+    row index of a student in the response matrix
+    '''
+    i = np.searchsorted(rm['students'],studentID)
+    if i>=len(rm['students']) or rm['students'][i]!=studentID:
+        raise KeyError("Student %s is not in the response matrix" % studentID)
+    return i
+
+def focusFrame(rm,ws,avg,conceptWeight,minWrong=5,avgColumn='classAvg'):
+    '''
+    Focus table entries for a working set, unsorted
+    args:
+        rm: response matrix
+        ws: working set from getWorkingSet
+        avg: average score to compare against, one per working set entry
+        conceptWeight: array of concept weights over rm['concepts']
+        minWrong: minimum number of wrong answers to make a recommendation
+        avgColumn: name of the column holding avg (classAvg, or cohortAvg for cohort comparisons)
+    '''
+    rec = _perfFrame(rm,ws)
+    rec['conceptWeight'] = conceptWeight[ws['cols']]
+    rec[avgColumn] = avg
+    rec = rec[['studentID','subject','concept','conceptWeight','wrong','score',avgColumn]].copy()
+    rec['scoreDiff'] = rec['score'] - rec[avgColumn]
+    rec['weightedScoreDiff'] = rec['scoreDiff']*rec['conceptWeight']
+
+    #only recommend areas where the student got at least a few wrong
+    rec = rec[rec['wrong']>=minWrong]
+
+    for col in ['conceptWeight','score',avgColumn,'scoreDiff']:
+        rec[col] = rec[col].round(2)
+    return rec
+
+def buildFocusTable(rm,studentID,testID,subject,minWrong=5):
+    '''
+    Matrix version of yleana_util.buildFocusTable: concepts in which this student is farthest
+    behind the rest of the class, weighted by concept weight.
+    args:
+        rm: response matrix
+        studentID: student ID integer
+        testID: test from which you want to build a recommendation table (None for all tests)
+        subject: math, reading, sentence, or writing
+        minWrong: minimum number of wrong answers to make a recommendation
+    returns:
+        rec: top 5 concepts ranked by weighted difference between the student's score and the class avg.
+    '''
+    agg = getClassAggregates(rm,testID,subject)
+    ws = getWorkingSet(agg,getStudentRow(rm,studentID))
+
+    rec = focusFrame(rm,ws,agg['classAvg'][ws['cols']],agg['conceptWeight'],minWrong)
+    order = np.argsort(rec['weightedScoreDiff'].values,kind='mergesort')
+    return rec.iloc[order].head()
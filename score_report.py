@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import datetime
+import gc
 from sklearn.cluster import KMeans
 
 #deal with encoding errors:
@@ -13,6 +14,9 @@ reload(sys)
 sys.setdefaultencoding("utf-8")
 
 import data_prep
+import response_matrix
+import cohorts
+import percentiles
 from yleana_util import *
 
 def makeHTMLTable(df):
@@ -33,7 +37,7 @@ def groupData(df,columns,statVar):
     groupedDF['mean'] = groupedDF['mean'].round(2)
     return groupedDF
 
-def buildFocusTable(df,studentID,testID,subject,passingThreshold=0.6,minWrong=5,toHTML=True):
+def buildFocusTable(df,studentID,testID,subject,passingThreshold=0.6,minWrong=5,toHTML=True,rm=None,cohortLevel=None):
     '''
     Get a data frame of concepts in which this student is farthest behind the rest of the class, weighted by concept weight.
     These are recommendations for further study
@@ -45,14 +49,38 @@ def buildFocusTable(df,studentID,testID,subject,passingThreshold=0.6,minWrong=5,
         passingThreshold: minimum score to pass 
         minWrong: minimum number of wrong answers to make a recommendation
         toHTML: convert table to HTML (default True)
+        rm: response matrix from response_matrix.buildResponseMatrix.  If given, scores come
+            from the cached sparse aggregates instead of regrouping df, and the table gets
+            the student's percentile rank on each concept.
+        cohortLevel: with rm, compare against the student's own class, campus or program
+            (see cohorts.assignCohorts) instead of everyone in df
     returns:
         rec: Dataframe of concepts in which this student is farthest behind the rest of the class,
                 ranked by the difference between this student's % correct and the class avg.
     '''
+    if rm is not None and cohortLevel is not None:
+        rec = cohorts.buildFocusTable(rm,studentID,testID,subject,cohortLevel,minWrong=minWrong)
+    elif rm is not None:
+        rec = response_matrix.buildFocusTable(rm,studentID,testID,subject,minWrong=minWrong)
+    else:
+        rec = buildFocusTableFromFrame(df,studentID,testID,subject,passingThreshold,minWrong)
+    if rm is not None:
+        rec = percentiles.addPercentileRanks(rm,rec,testID)
+    
+    rec.drop(['studentID','subject'],axis='columns',inplace=True)
     
+    if toHTML:
+        return makeHTMLTable(rec)
+    else:
+        return rec
+
+def buildFocusTableFromFrame(df,studentID,testID,subject,passingThreshold=0.6,minWrong=5):
+    '''
+    Row-wise version of buildFocusTable, regrouping the whole data frame
+    '''
     #optionally specify a testID, otherwise use all tests
     if testID is not None:
-        df = df.loc[df['testID']==testID,:].copy()
+        df = df.loc[df['testID']==testID,:]
     df = df.loc[df['subject']==subject,:]
         
     #list of concepts
@@ -73,14 +101,7 @@ def buildFocusTable(df,studentID,testID,subject,passingThreshold=0.6,minWrong=5,
     for col in ['conceptWeight','score','classAvg','scoreDiff']:
         rec[col] = rec[col].round(2)
     rec.sort('weightedScoreDiff',ascending=True, inplace=True)
-    rec = rec.loc[rec['studentID']==studentID].head()
-    
-    rec.drop(['studentID','subject'],axis='columns',inplace=True)
-    
-    if toHTML:
-        return makeHTMLTable(rec)
-    else:
-        return rec
+    return rec.loc[rec['studentID']==studentID].head()
 
 def getPerfByColumns(df,columns,statVar):
     '''
@@ -233,7 +254,7 @@ def conceptPerformanceOverTime(df,studentID,subject,concepts,homeDir):
     return figName
 
 #TODO: make lastTestID dynamically generated.  
-def buildRecTable(df,studentID,testID,lastTestID,subject,homeDir):
+def buildRecTable(df,studentID,testID,lastTestID,subject,homeDir,rm=None,cohortLevel=None):
     '''
     Make HTML version of recommendation tables and line chart to compare focus concept performance over time
     args:
@@ -242,6 +263,8 @@ def buildRecTable(df,studentID,testID,lastTestID,subject,homeDir):
         testID: name of the test
         subject: math, sentence, reading, writing
         homeDir: home directory
+        rm: optional response matrix for the focus tables
+        cohortLevel: with rm, compare against the student's own class, campus or program
     returns: 
         html_string: HTML tables and line chart
     '''
@@ -252,11 +275,11 @@ def buildRecTable(df,studentID,testID,lastTestID,subject,homeDir):
           'sentence':'Sentence Completion'
          }
     
-    focus = buildFocusTable(df,studentID,testID,subject)
+    focus = buildFocusTable(df,studentID,testID,subject,rm=rm,cohortLevel=cohortLevel)
     opportunity = buildOpportunityTable(df,studentID,testID,subject,difficulty=None)
     careless = buildOpportunityTable(df,studentID,testID,subject,difficulty='easy')
 
-    lastFocus = buildFocusTable(df,studentID,lastTestID,subject,toHTML=False)
+    lastFocus = buildFocusTable(df,studentID,lastTestID,subject,toHTML=False,rm=rm,cohortLevel=cohortLevel)
     focusList = list(lastFocus['concept'])
     figName = conceptPerformanceOverTime(df,studentID,subject,focusList,homeDir)
     
@@ -269,7 +292,9 @@ def buildRecTable(df,studentID,testID,lastTestID,subject,homeDir):
             <h2>'''+ titles[subject] +'''</h2>
             <h3>Focus Concepts</h3>
             <p>Concepts where the student is furthest behind the rest of the class.\
-            The plot shows progress on these concepts since the beginning of the course.</p>
+            The plot shows progress on these concepts since the beginning of the course.\
+            Percentile is the share of students on this test who scored below the student on the concept,\
+            with students who tied counted as half below.</p>
             <img src=../../plots/'''+figName+'''>
             '''+ focus +'''
         </div>
@@ -295,11 +320,13 @@ def getStudentName(df,studentID):
     studentName = df.loc[df['studentID']==studentID,'firstName'].iloc[0] + '_' + df.loc[df['studentID']==studentID,'lastName'].iloc[0]
     return studentName
 
-def buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir):
+def buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir,rm=None,cohortLevel=None):
     '''
     Build an html score report for a given student and Test ID, and export csv of scores by concept.  
     args:
         df, studentID, testID, homeDir
+        rm: optional response matrix for the focus tables
+        cohortLevel: with rm, compare against the student's own class, campus or program
     returns: 
         html score report
     '''
@@ -313,7 +340,7 @@ def buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir):
 
     #Loop through subjects
     for subject in ['sentence','reading','math','writing']:
-        recTables=recTables + buildRecTable(df,studentID,testID,lastTestID,subject,homeDir)
+        recTables=recTables + buildRecTable(df,studentID,testID,lastTestID,subject,homeDir,rm,cohortLevel)
 
     html_string = '''
 <html>
@@ -376,14 +403,110 @@ def buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir):
     f.write(html_string)
     f.close()
 
-def buildAllStudentReports(df,testID,lastTestID,homeDir):
+def prepareResponseMatrix(df,rosterPath=None,cohortLevel=None):
+    '''
+    Build the response matrix shared by every report, optionally with cohorts
+    args:
+        df: prepped data frame
+        rosterPath: roster csv to read the cohorts from (default: use df's cohort columns, eg. from data_prep.assignToClass)
+        cohortLevel: class, campus or program to compare students against (default: everyone in df)
+    returns:
+        the response matrix
     '''
-    loop through all students and write score reports for all of them
+    rm = response_matrix.buildResponseMatrix(df)
+    if cohortLevel is not None:
+        if rosterPath is not None:
+            roster = cohorts.getRosterFromFile(df,rosterPath,[cohortLevel])
+        else:
+            roster = cohorts.getRosterFromFrame(df,[cohortLevel])
+        cohorts.assignCohorts(rm,roster,[cohortLevel])
+    return rm
+
+def buildAllStudentReports(df,testID,lastTestID,homeDir,rosterPath=None,cohortLevel=None):
+    '''
+    loop through all students and write score reports for all of them.
+    Class averages and concept weights are computed once, in a sparse response matrix,
+    and shared by every student's report.
+    args:
+        rosterPath, cohortLevel: compare each student against their own cohort, see prepareResponseMatrix
     '''
     print "Building all student reports..."
+    rm = prepareResponseMatrix(df,rosterPath,cohortLevel)
     for studentID in df['studentID'].unique():
         print "Building report for %s ..." % studentID
-        buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir)
+        buildStudentScoreReport(df,studentID,testID,lastTestID,homeDir,rm,cohortLevel)
+
+def getBlockSize(df,memoryBudgetMB,workingSetFactor=4):
+    '''
+    number of students per block that fits in what is left of the memory budget
+    args:
+        df: prepped data frame
+        memoryBudgetMB: target for the process's resident memory, in MB
+        workingSetFactor: memory used while building reports, as a multiple of the students' rows
+    '''
+    #most columns are strings, so count the objects they point to, not just the pointers
+    try:
+        frameBytes = df.memory_usage(index=True,deep=True).sum()
+    except TypeError:
+        frameBytes = df.memory_usage(index=True).sum()
+    bytesPerStudent = frameBytes/float(df['studentID'].nunique())
+    headroom = (memoryBudgetMB - getCurrentRSS())*1024*1024
+    if not headroom > 0:
+        return 1
+    return max(1,int(headroom/(bytesPerStudent*workingSetFactor)))
+
+def buildAllStudentReportsBounded(df,testID,lastTestID,homeDir,memoryBudgetMB=512,rosterPath=None,cohortLevel=None):
+    '''
+    Memory-bounded version of buildAllStudentReports.
+    Students are streamed in blocks of consecutive studentIDs.  Each report only sees a slice holding that
+    student's rows, and class comparisons come from the shared response matrix, so nothing regroups or copies
+    the full frame.  Blocks are sized to fit the budget, and halved whenever a block finishes over it.
+    args:
+        df: prepped data frame
+        testID, lastTestID, homeDir: as in buildAllStudentReports
+        memoryBudgetMB: target for the process's resident memory, in MB
+        rosterPath, cohortLevel: compare each student against their own cohort, see prepareResponseMatrix
+    returns:
+        memStats: dictionary with peakRSS and steadyRSS (median RSS after each block) in MB, and the final blockSize
+    '''
+    print "Building all student reports in memory-bounded blocks..."
+    rm = prepareResponseMatrix(df,rosterPath,cohortLevel)
+
+    #positions of each student's rows, in studentID order
+    order = np.argsort(df['studentID'].values,kind='mergesort')
+    sortedIDs = df['studentID'].values[order]
+    students = rm['students']
+    starts = np.searchsorted(sortedIDs,students,side='left')
+    ends = np.searchsorted(sortedIDs,students,side='right')
+    del sortedIDs
+
+    blockSize = getBlockSize(df,memoryBudgetMB)
+    blockRSS = []
+    first = 0
+    while first < len(students):
+        last = min(first+blockSize,len(students))
+        blockStart = starts[first]
+        block = df.take(order[blockStart:ends[last-1]])
+        for k in range(first,last):
+            print "Building report for %s ..." % students[k]
+            studentDF = block.iloc[starts[k]-blockStart:ends[k]-blockStart]
+            buildStudentScoreReport(studentDF,students[k],testID,lastTestID,homeDir,rm,cohortLevel)
+        del block, studentDF
+
+        #release the block's figures and frames before measuring
+        plt.close('all')
+        gc.collect()
+        rss = getCurrentRSS()
+        blockRSS.append(rss)
+        print "Finished students %i-%i of %i, RSS %.0f MB" % (first+1,last,len(students),rss)
+        if rss > memoryBudgetMB and blockSize > 1:
+            blockSize = max(1,blockSize//2)
+            print "Warning: over the %i MB memory budget, reducing block size to %i" % (memoryBudgetMB,blockSize)
+        first = last
+
+    memStats = {'peakRSS':getPeakRSS(),'steadyRSS':np.median(blockRSS),'blockSize':blockSize}
+    print "Peak RSS: %.0f MB, steady-state RSS: %.0f MB" % (memStats['peakRSS'],memStats['steadyRSS'])
+    return memStats
 
 def makeFakeSecondTest(df):
     df['testDate'] = datetime.datetime(2015, 6, 27)
@@ -406,7 +529,12 @@ def main():
     HOME_DIR = './'
     LAST_TEST_ID = 'YL_1_PP_SAT_S0114'
     TEST_ID = 'YL_2_PP_SAT_S0112'
-    buildAllStudentReports(df,testID=TEST_ID,lastTestID=LAST_TEST_ID,homeDir=HOME_DIR)
+    #to compare students against their own class instead of everyone, set ROSTER_PATH = 'data/roster.csv'
+    #and COHORT_LEVEL to 'class', 'campus' or 'program'
+    ROSTER_PATH = None
+    COHORT_LEVEL = None
+    buildAllStudentReports(df,testID=TEST_ID,lastTestID=LAST_TEST_ID,homeDir=HOME_DIR,
+                           rosterPath=ROSTER_PATH,cohortLevel=COHORT_LEVEL)
 
 if __name__ == '__main__':
     main()
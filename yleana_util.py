@@ -1,8 +1,57 @@
+import os
+import sys
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.cluster import KMeans
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def getPeakRSS():
+    '''
+    peak resident memory of this process in MB, since it started or since the last resetPeakRSS.
+    Read from /proc where there is one, otherwise from the resource module (NaN where neither is available)
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on mac, kilobytes on linux
+    if sys.platform == 'darwin':
+        return peak/1024.0/1024.0
+    return peak/1024.0
+
+def resetPeakRSS():
+    '''
+    reset the peak resident memory to the current one (linux only), so getPeakRSS measures from here
+    returns: True if the peak was reset
+    '''
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def getCurrentRSS():
+    '''
+    current resident memory of this process in MB, read from /proc.  Falls back to the peak where there is no /proc.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')/1024.0/1024.0
+    except (IOError, OSError, ValueError):
+        return getPeakRSS()
 
 def groupByStudentTypeConcept(df):
     studentsDF = df[['firstName','lastName','subject','concept','correct']]